@@ -10,23 +10,34 @@ Date: 2025-02-01
 """
 
 import pyodbc
+import asyncio
 import time
+import random
 import datetime
 import configparser
 import logging
+import logging.handlers
+import queue
+import atexit
 import sys
-from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
-from concurrent.futures import ThreadPoolExecutor
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler, AsyncConnectionErrorRetryHandler
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.web.async_slack_response import AsyncSlackResponse
 from dataclasses import dataclass
-from typing import Optional, Dict, Any
+from functools import lru_cache
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 import signal
-import json
+import threading
+import orjson
+import aiohttp
+import os
+import tempfile
 from pathlib import Path
 
 # --- Dataclasses for Configuration and Metrics ---
 
-@dataclass
+@dataclass(frozen=True)
 class DatabaseConfig:
     driver: str
     server: str
@@ -36,11 +47,17 @@ class DatabaseConfig:
     pwd: str
     tds_version: str
 
-@dataclass
+@dataclass(frozen=True)
 class SlackConfig:
     bot_token: str
     channel: str
 
+@dataclass(frozen=True)
+class PollConfig:
+    interval: float
+    interval_min: float
+    interval_max: float
+
 @dataclass
 class Metrics:
     notifications_sent: int = 0
@@ -49,9 +66,44 @@ class Metrics:
     db_connection_failures: int = 0
     last_successful_check: Optional[datetime.datetime] = None
 
-# Global metrics instance and shutdown flag.
+# Global metrics instance, shutdown flag, and shutdown event (wakes the poller immediately).
 metrics = Metrics()
 shutdown_flag = False
+shutdown_event = threading.Event()
+
+# Loop-side counterpart of shutdown_event, created by the monitor loop so shutdown waits can be
+# awaited on the event loop instead of blocking a worker thread.
+_async_shutdown_event: Optional[asyncio.Event] = None
+
+# Signals that trigger a graceful shutdown.
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+# Set whenever a metrics counter changes, so the monitor loop only writes metrics when needed.
+_metrics_dirty = False
+
+# Backoff bounds (in seconds) for re-establishing a dropped database connection.
+RECONNECT_DELAY_INITIAL = 5
+RECONNECT_DELAY_MAX = 300
+
+# Fraction of the poll interval by which each wait is randomly lengthened or shortened.
+POLL_JITTER = 0.2
+
+# Login and query timeout (in seconds) for database connections.
+DB_TIMEOUT = 10
+
+# Upper bound on events returned per poll, and how many rows are pulled from the cursor at a time
+# (also used as the cursor's arraysize).
+MAX_EVENTS_PER_POLL = 100
+FETCH_BATCH_SIZE = 100
+
+# Oldest FreeTDS release accepted at startup; older drivers handle small TDS packets poorly.
+MIN_FREETDS_VERSION = (1, 3)
+
+# Slack allows 50 blocks per message; one is used by the header, the rest hold one event each.
+MAX_ROWS_PER_MESSAGE = 49
+
+# Slack's limit on the text of a single section field.
+SLACK_FIELD_MAX_CHARS = 2000
 
 # --- Logging Setup ---
 
@@ -59,6 +111,8 @@ def setup_logging(log_file: Optional[str] = None) -> logging.Logger:
     """
     Configures and returns a logger to output debug, info, and error messages.
     
+    Pending records are flushed by the queue listener when the process exits.
+    
     Args:
         log_file (Optional[str]): Path to a file to log messages, if provided.
         
@@ -70,21 +124,30 @@ def setup_logging(log_file: Optional[str] = None) -> logging.Logger:
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+    handlers = [console_handler]
     if log_file:
         file_handler = logging.FileHandler(log_file)
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+    
+    # Records are queued by the caller and written by a background listener thread, so
+    # console and file I/O never block the monitor loop or the database worker threads.
+    # SimpleQueue.put is reentrant, so logging from the signal handler cannot deadlock.
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
     return logger
 
 # --- Configuration Validation and Reading ---
 
-def validate_config(config: configparser.ConfigParser) -> tuple[DatabaseConfig, SlackConfig]:
+def validate_config(config: configparser.RawConfigParser) -> tuple[DatabaseConfig, SlackConfig]:
     """
     Validates that all required configuration parameters exist in the config file.
     
     Args:
-        config (configparser.ConfigParser): Parsed configuration data.
+        config (configparser.RawConfigParser): Parsed configuration data.
         
     Returns:
         tuple: A tuple containing DatabaseConfig and SlackConfig objects.
@@ -92,63 +155,65 @@ def validate_config(config: configparser.ConfigParser) -> tuple[DatabaseConfig,
     Raises:
         ValueError: If a required configuration parameter is missing.
     """
-    required_db_params = {
-        'DRIVER': str,
-        'SERVER': str,
-        'PORT': str,
-        'DATABASE': str,
-        'UID': str,
-        'PWD': str,
-        'TDS_VERSION': str
-    }
+    required_db_params = ('DRIVER', 'SERVER', 'PORT', 'DATABASE', 'UID', 'PWD', 'TDS_VERSION')
+    required_slack_params = ('BOT_TOKEN', 'CHANNEL')
     
-    required_slack_params = {
-        'BOT_TOKEN': str,
-        'CHANNEL': str
-    }
+    # Option names are stored lower-cased by the parser, so compare against lower-cased names.
+    db_present = set(config.options('DATABASE')) if config.has_section('DATABASE') else set()
+    missing_db = {param.lower() for param in required_db_params} - db_present
+    if missing_db:
+        raise ValueError(f"Missing required DATABASE parameters: {', '.join(sorted(p.upper() for p in missing_db))}")
     
-    db_config = {}
-    for param, param_type in required_db_params.items():
-        value = config.get('DATABASE', param, fallback=None)
-        if value is None:
-            raise ValueError(f"Missing required DATABASE parameter: {param}")
-        db_config[param.lower()] = param_type(value)
+    slack_present = set(config.options('SLACK')) if config.has_section('SLACK') else set()
+    missing_slack = {param.lower() for param in required_slack_params} - slack_present
+    if missing_slack:
+        raise ValueError(f"Missing required SLACK parameters: {', '.join(sorted(p.upper() for p in missing_slack))}")
     
-    slack_config = {}
-    for param, param_type in required_slack_params.items():
-        value = config.get('SLACK', param, fallback=None)
-        if value is None:
-            raise ValueError(f"Missing required SLACK parameter: {param}")
-        slack_config[param.lower()] = param_type(value)
+    db_config = DatabaseConfig(**{param.lower(): config.get('DATABASE', param) for param in required_db_params})
+    slack_config = SlackConfig(**{param.lower(): config.get('SLACK', param) for param in required_slack_params})
     
-    return DatabaseConfig(**db_config), SlackConfig(**slack_config)
+    return db_config, slack_config
 
-def read_config(config_file: str = "config.ini") -> tuple[DatabaseConfig, SlackConfig, int]:
+@lru_cache(maxsize=1)
+def read_config(config_file: str = "config.ini") -> tuple[DatabaseConfig, SlackConfig, PollConfig]:
     """
-    Reads the configuration file and returns the database config, slack config, and poll interval.
+    Reads the configuration file and returns the database config, slack config, and polling config.
+    
+    POLL_INTERVAL_MIN and POLL_INTERVAL_MAX default to POLL_INTERVAL, which disables adaptive polling.
+    
+    The result is cached, since the configuration does not change for the lifetime of the process.
     
     Args:
         config_file (str): Path to the configuration file.
         
     Returns:
-        tuple: A tuple containing DatabaseConfig, SlackConfig, and poll interval (int).
+        tuple: A tuple containing DatabaseConfig, SlackConfig, and PollConfig objects.
         
     Exits:
         If configuration file is missing or contains errors.
     """
-    config = configparser.ConfigParser()
+    # No interpolation: values such as passwords may legitimately contain '%'.
+    config = configparser.RawConfigParser()
     if not config.read(config_file):
         logger.error(f"Configuration file {config_file} not found or is empty.")
         sys.exit(1)
     
     try:
         db_config, slack_config = validate_config(config)
-        poll_interval = config.getint('GENERAL', 'POLL_INTERVAL', fallback=60)
-        return db_config, slack_config, poll_interval
+        poll_interval = config.getfloat('GENERAL', 'POLL_INTERVAL', fallback=5.0)
+        poll_config = PollConfig(
+            interval=poll_interval,
+            interval_min=config.getfloat('GENERAL', 'POLL_INTERVAL_MIN', fallback=poll_interval),
+            interval_max=config.getfloat('GENERAL', 'POLL_INTERVAL_MAX', fallback=poll_interval)
+        )
+        if not 0 < poll_config.interval_min <= poll_config.interval <= poll_config.interval_max:
+            raise ValueError("Poll intervals must satisfy 0 < POLL_INTERVAL_MIN <= POLL_INTERVAL <= POLL_INTERVAL_MAX")
+        return db_config, slack_config, poll_config
     except Exception as e:
         logger.error(f"Configuration error: {e}")
         sys.exit(1)
 
+@lru_cache(maxsize=4)
 def build_connection_string(config: DatabaseConfig) -> str:
     """
     Constructs the connection string for pyodbc using the provided database configuration.
@@ -183,24 +248,76 @@ def get_database_connection(connection_string: str, max_retries: int = 3, retry_
     Returns:
         Optional[pyodbc.Connection]: The database connection object if successful, otherwise None.
     """
+    global _metrics_dirty
     metrics.db_connection_attempts += 1
+    _metrics_dirty = True
     for attempt in range(max_retries):
         try:
-            conn = pyodbc.connect(connection_string)
+            # The workload is SELECT-only: autocommit avoids implicit transactions, and explicit
+            # login/query timeouts keep a stalled FreeTDS connection from hanging the monitor.
+            conn = pyodbc.connect(connection_string, autocommit=True, readonly=True, timeout=DB_TIMEOUT)
+            conn.timeout = DB_TIMEOUT
+            # Bind str parameters (the watermark time) as UTF-8 VARCHAR rather than NVARCHAR.
+            conn.setencoding(encoding='utf-8')
             logger.info("Connected to the database successfully.")
             return conn
         except Exception as e:
             if attempt < max_retries - 1:
                 logger.warning(f"Database connection attempt {attempt + 1} failed: {e}. Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                if shutdown_event.wait(retry_delay):
+                    return None
             else:
                 logger.error(f"Failed to connect after {max_retries} attempts: {e}")
                 metrics.db_connection_failures += 1
+                _metrics_dirty = True
                 return None
 
+def close_database_connection(conn: Optional[pyodbc.Connection]):
+    """
+    Closes a database connection, ignoring errors from connections that are already broken.
+    
+    Args:
+        conn (Optional[pyodbc.Connection]): The connection to close, or None.
+    """
+    if conn is None:
+        return
+    try:
+        conn.close()
+    except pyodbc.Error as e:
+        logger.warning(f"Error while closing database connection: {e}")
+
+def check_driver_version(conn: pyodbc.Connection) -> bool:
+    """
+    Verifies that a FreeTDS ODBC driver is at least MIN_FREETDS_VERSION. Other drivers are accepted as-is.
+    
+    Args:
+        conn (pyodbc.Connection): An open database connection.
+        
+    Returns:
+        bool: True if the driver is acceptable, False if it is a FreeTDS release that is too old.
+    """
+    driver_name = conn.getinfo(pyodbc.SQL_DRIVER_NAME)
+    driver_version = conn.getinfo(pyodbc.SQL_DRIVER_VER)
+    if 'tds' not in driver_name.lower():
+        return True
+    
+    # ODBC reports versions as "##.##.####".
+    try:
+        version = tuple(int(part) for part in driver_version.split('.')[:2])
+    except ValueError:
+        logger.warning(f"Could not parse FreeTDS driver version '{driver_version}'. Skipping version check.")
+        return True
+    
+    if version < MIN_FREETDS_VERSION:
+        minimum = '.'.join(str(part) for part in MIN_FREETDS_VERSION)
+        logger.error(f"FreeTDS driver {driver_version} is too old. Version {minimum} or newer is required.")
+        return False
+    return True
+
 def health_check(connection_string: str) -> bool:
     """
-    Performs a simple health check on the database by executing a simple query.
+    Performs a simple health check on the database by executing a simple query, and verifies
+    the ODBC driver version.
     
     Args:
         connection_string (str): The ODBC connection string.
@@ -216,7 +333,10 @@ def health_check(connection_string: str) -> bool:
             cursor.execute("SELECT 1")
             cursor.fetchone()
             cursor.close()
+            driver_ok = check_driver_version(conn)
             conn.close()
+            if not driver_ok:
+                return False
             metrics.last_successful_check = datetime.datetime.now()
             return True
     except Exception as e:
@@ -229,6 +349,9 @@ def save_metrics(metrics_file: str = "monitor_metrics.json"):
     """
     Saves the current metrics to a JSON file.
     
+    The file is written compactly to a temporary file in the same directory and then moved
+    into place, so a crash or power loss mid-write never leaves a truncated metrics file.
+    
     Args:
         metrics_file (str): Path to the file where metrics are saved.
     """
@@ -237,95 +360,288 @@ def save_metrics(metrics_file: str = "monitor_metrics.json"):
         "failed_notifications": metrics.failed_notifications,
         "db_connection_attempts": metrics.db_connection_attempts,
         "db_connection_failures": metrics.db_connection_failures,
-        "last_successful_check": metrics.last_successful_check.isoformat() if metrics.last_successful_check else None,
-        "timestamp": datetime.datetime.now().isoformat()
+        "last_successful_check": metrics.last_successful_check,  # orjson writes datetimes as ISO 8601.
+        "timestamp": datetime.datetime.now()
     }
     
+    temp_name = None
     try:
-        with open(metrics_file, 'w') as f:
-            json.dump(metrics_data, f, indent=2)
+        metrics_path = Path(metrics_file).resolve()
+        with tempfile.NamedTemporaryFile('wb', dir=metrics_path.parent, prefix=f".{metrics_path.name}.",
+                                         suffix=".tmp", delete=False) as f:
+            temp_name = f.name
+            f.write(orjson.dumps(metrics_data))
+        # Temporary files are created 0600; keep the metrics file world-readable as before.
+        os.chmod(temp_name, 0o644)
+        os.replace(temp_name, metrics_path)
     except Exception as e:
         logger.error(f"Failed to save metrics: {e}")
+        if temp_name is not None:
+            try:
+                os.unlink(temp_name)
+            except OSError:
+                pass
 
 # --- Slack Notification Formatting and Sending ---
 
-def format_slack_message(row: pyodbc.Row) -> Dict[str, Any]:
+def orjson_dumps(obj: Any) -> str:
     """
-    Formats an offline event row into a Slack block message.
+    JSON serializer for aiohttp request bodies, using orjson instead of the stdlib json module.
     
     Args:
-        row (pyodbc.Row): A row object returned from the database query.
+        obj (Any): The object to serialize.
         
     Returns:
-        Dict[str, Any]: A dictionary representing the Slack message in Block Kit format.
+        str: The JSON document (aiohttp expects str, while orjson produces bytes).
     """
-    return {
-        "blocks": [
-            {
-                "type": "header",
-                "text": {
-                    "type": "plain_text",
-                    "text": "🚨 Embed Swiper Offline Alert!"
-                }
-            },
+    return orjson.dumps(obj).decode()
+
+def create_slack_client(bot_token: str, session: Optional[aiohttp.ClientSession] = None,
+                        max_retries: int = 3) -> AsyncWebClient:
+    """
+    Creates an asynchronous Slack client that retries rate-limited and failed-connection requests.
+    
+    The built-in slack_sdk retry handlers honour the Retry-After header on HTTP 429 and use
+    backoff with jitter for connection errors.
+    
+    Args:
+        bot_token (str): Slack bot user OAuth token.
+        session (Optional[aiohttp.ClientSession]): HTTP session to send requests with. The caller
+            owns the session and is responsible for closing it.
+        max_retries (int): Maximum number of retries per request for each error type.
+        
+    Returns:
+        AsyncWebClient: The configured Slack client.
+    """
+    return AsyncWebClient(
+        token=bot_token,
+        session=session,
+        retry_handlers=[
+            AsyncRateLimitErrorRetryHandler(max_retry_count=max_retries),
+            AsyncConnectionErrorRetryHandler(max_retry_count=max_retries),
+        ]
+    )
+
+class ThrottledSlack:
+    """
+    Wraps a Slack AsyncWebClient so that concurrent chat_postMessage calls are paced to at
+    most one per min_interval seconds, backing off further when Slack returns HTTP 429.
+    """
+    
+    def __init__(self, client: AsyncWebClient, min_interval: float = 1.0, max_concurrent: int = 3):
+        """
+        Args:
+            client (AsyncWebClient): The Slack client instance to wrap.
+            min_interval (float): Minimum time in seconds between consecutive sends.
+            max_concurrent (int): Maximum number of requests in flight at once.
+        """
+        self.client = client
+        self.min_interval = min_interval
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._lock = asyncio.Lock()
+        self._next_allowed = time.monotonic()
+    
+    async def _wait_for_slot(self):
+        """Waits until the next send is allowed, then reserves the following slot."""
+        async with self._lock:
+            await asyncio.sleep(max(0.0, self._next_allowed - time.monotonic()))
+            self._next_allowed = time.monotonic() + self.min_interval
+    
+    async def chat_postMessage(self, **kwargs) -> AsyncSlackResponse:
+        """
+        Sends a message via the wrapped client once the rate limiter allows it.
+        
+        Args:
+            **kwargs: Arguments passed through to AsyncWebClient.chat_postMessage.
+            
+        Returns:
+            AsyncSlackResponse: The response from the Slack API.
+            
+        Raises:
+            SlackApiError: If the request fails. On HTTP 429 the Retry-After delay is applied
+                to subsequent sends before the error is re-raised.
+        """
+        async with self._semaphore:
+            await self._wait_for_slot()
+            try:
+                return await self.client.chat_postMessage(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code == 429:
+                    headers = e.response.headers
+                    retry_after = float(headers.get("Retry-After", headers.get("retry-after", self.min_interval)))
+                    logger.warning(f"Slack rate limit hit. Pausing sends for {retry_after} seconds...")
+                    async with self._lock:
+                        self._next_allowed = max(self._next_allowed, time.monotonic() + retry_after)
+                raise
+
+# Message title, also sent as the plain-text fallback that Slack requires alongside blocks.
+ALERT_TITLE = "🚨 Embed Swiper Offline Alert!"
+
+# The header never changes, so it is built once and shared by every message.
+_HEADER_BLOCK = {
+    "type": "header",
+    "text": {
+        "type": "plain_text",
+        "text": ALERT_TITLE
+    }
+}
+
+def format_field(label: str, value: Any) -> Dict[str, str]:
+    """
+    Builds a section field, truncating its text to Slack's per-field limit. One oversized field
+    would otherwise make Slack reject the whole batched message with invalid_blocks.
+    
+    Args:
+        label (str): The field label.
+        value (Any): The field value.
+        
+    Returns:
+        Dict[str, str]: A mrkdwn text object for a section's fields.
+    """
+    text = f"*{label}:*\n{value}"
+    if len(text) > SLACK_FIELD_MAX_CHARS:
+        text = text[:SLACK_FIELD_MAX_CHARS - 1] + "…"
+    return {"type": "mrkdwn", "text": text}
+
+def format_slack_message(rows: List[pyodbc.Row]) -> List[Dict[str, Any]]:
+    """
+    Formats a batch of offline event rows into a single Slack block message.
+    
+    The message has one header block followed by one section block per row, so callers must
+    pass at most MAX_ROWS_PER_MESSAGE rows to stay within Slack's 50-block limit.
+    
+    Args:
+        rows (List[pyodbc.Row]): Row objects returned from the database query.
+        
+    Returns:
+        List[Dict[str, Any]]: The message blocks in Block Kit format.
+    """
+    today = datetime.date.today()
+    return [
+        _HEADER_BLOCK,
+        *(
             {
                 "type": "section",
                 "fields": [
-                    {"type": "mrkdwn", "text": f"*Game:*\n{row.swiper_description}"},
-                    {"type": "mrkdwn", "text": f"*User:*\n{row.user_name}"},
-                    {"type": "mrkdwn", "text": f"*Days Offline:*\n{row.Days_Offline}"},
-                    {"type": "mrkdwn", "text": f"*Log Time:*\n{row.log_datetime}"}
+                    format_field("Game", row.swiper_description),
+                    format_field("User", row.user_name),
+                    format_field("Days Offline", (today - row.log_datetime.date()).days),
+                    format_field("Log Time", row.log_datetime),
+                    format_field("Comment", row.comment)
                 ]
-            },
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": f"*Comment:*\n{row.comment}"
-                }
             }
-        ]
-    }
+            for row in rows
+        )
+    ]
 
-def send_slack_notification(slack_client: WebClient, channel: str, message: Dict[str, Any],
-                            max_retries: int = 3, retry_delay: int = 5) -> bool:
+async def send_slack_notification(slack_client: ThrottledSlack, channel: str, blocks: List[Dict[str, Any]]) -> bool:
     """
-    Attempts to send a Slack notification, retrying on failure.
+    Sends a Slack notification.
+    
+    Retries for rate limiting and connection errors are handled by the retry handlers attached
+    to the underlying AsyncWebClient (see create_slack_client).
     
     Args:
-        slack_client (WebClient): The Slack client instance.
+        slack_client (ThrottledSlack): The rate-limited Slack client.
         channel (str): Slack channel to send the message to.
-        message (Dict[str, Any]): The message payload in Slack Block Kit format.
-        max_retries (int): Maximum number of attempts.
-        retry_delay (int): Delay in seconds between attempts.
+        blocks (List[Dict[str, Any]]): The message blocks in Slack Block Kit format.
         
     Returns:
         bool: True if the notification was sent successfully, False otherwise.
     """
-    for attempt in range(max_retries):
-        try:
-            response = slack_client.chat_postMessage(
-                channel=channel,
-                blocks=message["blocks"]  # Pass the blocks directly as a list.
-            )
-            logger.info(f"Notification sent to Slack: {response.data}")
-            metrics.notifications_sent += 1
-            return True
-        except SlackApiError as e:
-            error_msg = e.response.get("error", str(e))
-            if attempt < max_retries - 1:
-                logger.warning(f"Slack notification attempt {attempt + 1} failed: {error_msg}. Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-            else:
-                logger.error(f"Failed to send Slack notification after {max_retries} attempts: {error_msg}")
-                metrics.failed_notifications += 1
-                return False
+    global _metrics_dirty
+    try:
+        response = await slack_client.chat_postMessage(
+            channel=channel,
+            blocks=blocks,
+            text=ALERT_TITLE
+        )
+        logger.info(f"Notification sent to Slack: {response.data}")
+        metrics.notifications_sent += 1
+        _metrics_dirty = True
+        return True
+    except SlackApiError as e:
+        error_msg = e.response.get("error", str(e))
+        logger.error(f"Failed to send Slack notification: {error_msg}")
+        metrics.failed_notifications += 1
+        _metrics_dirty = True
+        return False
 
 # --- Fetching Events from the Database ---
 
-def fetch_offline_events(cursor: pyodbc.Cursor, last_check: datetime.datetime) -> list:
+# game_events.event_type recorded when a swiper is placed offline, and swiper_units.status of an
+# active swiper. Bound as parameters so the statement text, and its cached plan, stay constant.
+OFFLINE_EVENT_TYPE = 44
+ACTIVE_SWIPER_STATUS = 1
+
+# Kept at module level so the identical statement text is reused on every poll; with a
+# long-lived cursor the driver prepares it once and SQL Server reuses the cached plan.
+_OFFLINE_QUERY_SQL = """
+WITH offline_events AS (
+    SELECT
+        ROW_NUMBER() OVER (PARTITION BY gs.game_id ORDER BY gl.log_datetime DESC) as row,
+        gs.game_id,
+        gs.swiper_description,
+        u.user_name,
+        gl.comment,
+        CAST(gl.log_datetime AS datetime2(7)) as log_datetime
+    FROM ecs7.dbo.game_swipers gs
+    JOIN (
+        SELECT game_id, log_datetime,
+               STRING_AGG(TRIM(comment), ', ') as Comment
+        FROM ecs7.dbo.game_log
+        WHERE comment LIKE 'Swiper placed Offline%'
+          -- Coarse pre-filter so the window function only ranks recent events; the exact
+          -- watermark comparison is below. The margin absorbs datetime/datetime2 rounding.
+          AND log_datetime >= DATEADD(ms, -10, CONVERT(datetime2(7), ?, 121))
+        GROUP BY game_id, log_datetime
+    ) gl ON gs.game_id = gl.game_id
+    JOIN ecs7.dbo.game_events ge
+        ON ge.game_id = gl.game_id
+           AND ge.event_time = gl.log_datetime
+    JOIN ecs7.dbo.users u
+        ON ge.user_id = u.user_id
+    JOIN ecs7.dbo.swiper_units su
+        ON su.game_id = gs.game_id
+    WHERE gs.retired IS NULL
+      AND ge.event_type = ?
+      AND su.status = ?
+)
+SELECT TOP (?) game_id, swiper_description, user_name, comment, log_datetime,
+       CONVERT(char(27), log_datetime, 121) as watermark_time
+FROM offline_events
+WHERE row = 1
+  AND (log_datetime > CONVERT(datetime2(7), ?, 121)
+       OR (log_datetime = CONVERT(datetime2(7), ?, 121) AND game_id > ?))
+ORDER BY log_datetime, game_id
+"""
+
+def format_watermark_time(value: datetime.datetime) -> str:
+    """
+    Formats a timestamp the way the offline query renders watermark_time (ODBC canonical, style 121,
+    with seven fractional digits), so it can seed the initial watermark.
+    
+    Args:
+        value (datetime.datetime): The timestamp to format.
+        
+    Returns:
+        str: The formatted timestamp.
+    """
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f') + '0'
+
+def fetch_offline_events(cursor: pyodbc.Cursor, last_check: Tuple[str, int],
+                         max_rows: int = MAX_EVENTS_PER_POLL) -> Iterator[pyodbc.Row]:
     """
-    Executes a query to retrieve new embed swiper offline events that occurred after the last_check timestamp.
+    Executes a query to retrieve new embed swiper offline events that occurred after the last_check watermark.
+    
+    The watermark is a (watermark_time, game_id) pair taken from the last row already processed.
+    watermark_time is the event time rendered by SQL Server at full datetime2(7) precision, so it
+    round-trips exactly, and game_id breaks ties between games that went offline at the same
+    instant. Rows come back ordered by that pair, so each poll resumes exactly where the previous
+    one stopped, even when the result set is capped.
+    
+    Rows are streamed from the cursor in batches of its arraysize and yielded as they arrive, and the
+    result set is capped server-side at max_rows so a single poll never pulls an unbounded result.
     
     This query uses a Common Table Expression (CTE) similar to your initial SQL. Note that the subquery
     now includes events where the comment starts with "Swiper placed Offline%" (using LIKE) so that you
@@ -333,50 +649,24 @@ def fetch_offline_events(cursor: pyodbc.Cursor, last_check: datetime.datetime) -
     
     Args:
         cursor (pyodbc.Cursor): The database cursor used for executing the query.
-        last_check (datetime.datetime): Timestamp to filter events.
+        last_check (Tuple[str, int]): (watermark_time, game_id) of the last processed event.
+        max_rows (int): Maximum number of rows returned by the query.
         
-    Returns:
-        list: A list of rows containing event data.
-    """
-    query = """
-    WITH offline_events AS (
-        SELECT
-            ROW_NUMBER() OVER (PARTITION BY gs.game_id ORDER BY gl.log_datetime DESC) as row,
-            gs.swiper_description,
-            u.user_name,
-            gl.comment,
-            gl.log_datetime,
-            DATEDIFF(dd, gl.log_datetime, CURRENT_TIMESTAMP) as Days_Offline
-        FROM ecs7.dbo.game_swipers gs
-        JOIN (
-            SELECT game_id, log_datetime,
-                   STRING_AGG(TRIM(comment), ', ') as Comment
-            FROM ecs7.dbo.game_log
-            WHERE comment LIKE 'Swiper placed Offline%'
-            GROUP BY game_id, log_datetime
-        ) gl ON gs.game_id = gl.game_id
-        JOIN ecs7.dbo.game_events ge
-            ON ge.game_id = gl.game_id
-               AND ge.event_time = gl.log_datetime
-        JOIN ecs7.dbo.users u
-            ON ge.user_id = u.user_id
-        JOIN ecs7.dbo.swiper_units su
-            ON su.game_id = gs.game_id
-        WHERE gs.retired IS NULL
-          AND ge.event_type = 44
-          AND su.status = 1
-    )
-    SELECT swiper_description, user_name, comment, log_datetime, Days_Offline
-    FROM offline_events
-    WHERE row = 1 AND log_datetime > ?
-    ORDER BY swiper_description
+    Yields:
+        pyodbc.Row: Rows containing event data.
+        
+    Raises:
+        pyodbc.Error: If the query fails or the connection drops. Errors are not swallowed, so a
+            failed poll is never mistaken for one that found no events.
     """
-    try:
-        cursor.execute(query, last_check)
-        return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"Error executing query: {e}")
-        return []
+    watermark_time, game_id = last_check
+    cursor.execute(_OFFLINE_QUERY_SQL, watermark_time, OFFLINE_EVENT_TYPE, ACTIVE_SWIPER_STATUS,
+                   max_rows, watermark_time, watermark_time, game_id)
+    while True:
+        batch = cursor.fetchmany()
+        if not batch:
+            break
+        yield from batch
 
 # --- Signal Handling for Graceful Shutdown ---
 
@@ -384,6 +674,9 @@ def signal_handler(signum: int, frame: Any):
     """
     Signal handler that sets a shutdown flag for graceful termination.
     
+    While the monitor loop runs, it is installed with loop.add_signal_handler, so it executes on
+    the event loop rather than interrupting arbitrary code.
+    
     Args:
         signum (int): Signal number.
         frame (Any): Current stack frame.
@@ -391,67 +684,197 @@ def signal_handler(signum: int, frame: Any):
     global shutdown_flag
     logger.info(f"Received signal {signum}. Initiating graceful shutdown...")
     shutdown_flag = True
+    shutdown_event.set()
+    if _async_shutdown_event is not None:
+        _async_shutdown_event.set()
+
+async def wait_for_shutdown(timeout: float) -> bool:
+    """
+    Waits up to timeout seconds for a shutdown signal without blocking the event loop.
+    
+    Args:
+        timeout (float): Maximum time in seconds to wait.
+        
+    Returns:
+        bool: True if shutdown was requested, False if the timeout elapsed.
+    """
+    if shutdown_event.is_set():
+        return True
+    try:
+        await asyncio.wait_for(_async_shutdown_event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
 
 # --- Main Monitoring Loop ---
 
-def monitor_swiper_offline_events(connection_string: str, slack_client: WebClient,
-                                  slack_channel: str, poll_interval: int):
+def poll_offline_events(conn: pyodbc.Connection, cursor: pyodbc.Cursor,
+                        last_check: Tuple[str, int]) -> List[pyodbc.Row]:
+    """
+    Probes the persistent connection and fetches new offline events in one blocking call.
+    
+    pyodbc is blocking, so the monitor loop runs this via asyncio.to_thread.
+    
+    Args:
+        conn (pyodbc.Connection): The persistent database connection.
+        cursor (pyodbc.Cursor): The long-lived cursor used for the offline query.
+        last_check (Tuple[str, int]): (watermark_time, game_id) of the last processed event.
+        
+    Returns:
+        List[pyodbc.Row]: Rows containing event data.
+        
+    Raises:
+        pyodbc.Error: If the connection has dropped or the query fails.
+    """
+    # Lightweight liveness probe on the persistent connection. It runs on a throwaway
+    # cursor so the long-lived one keeps the offline query prepared between polls.
+    conn.execute("SELECT 1").fetchone()
+    metrics.last_successful_check = datetime.datetime.now()
+    return list(fetch_offline_events(cursor, last_check))
+
+async def monitor_swiper_offline_events(connection_string: str, slack_client: ThrottledSlack,
+                                        slack_channel: str, poll_config: PollConfig):
     """
     Continuously monitors the database for new embed swiper offline events and sends Slack notifications.
     
-    Uses a ThreadPoolExecutor to send notifications concurrently.
+    A single database connection and cursor are kept open for the lifetime of the loop. Each poll
+    probes the connection with a lightweight query; if the connection has dropped it is torn down
+    and re-established with exponential backoff.
+    
+    The poll interval doubles after each poll that finds no events, up to poll_config.interval_max,
+    and drops back to poll_config.interval_min as soon as events appear. Each wait is jittered by
+    up to POLL_JITTER of the interval so multiple instances do not poll in lockstep.
+    
+    Database calls run in worker threads via asyncio.to_thread, while Slack notifications are sent
+    concurrently on the event loop.
     
     Args:
         connection_string (str): The database connection string.
-        slack_client (WebClient): The Slack client instance.
+        slack_client (ThrottledSlack): The rate-limited Slack client.
         slack_channel (str): The Slack channel for notifications.
-        poll_interval (int): Time in seconds between polling iterations.
+        poll_config (PollConfig): Poll interval settings, in seconds.
     """
-    last_check = datetime.datetime.now() - datetime.timedelta(minutes=1)
+    global _metrics_dirty, _async_shutdown_event
+    _async_shutdown_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in SHUTDOWN_SIGNALS:
+        loop.add_signal_handler(signum, signal_handler, signum, None)
+    
+    # Start one minute back; game_id 0 sorts before every real game at that instant.
+    last_check = (format_watermark_time(datetime.datetime.now() - datetime.timedelta(minutes=1)), 0)
     logger.info("Starting monitoring of embed swiper offline events...")
     
-    with ThreadPoolExecutor(max_workers=3) as pool:
-        while not shutdown_flag:
-            try:
-                if not health_check(connection_string):
-                    logger.error("Health check failed. Waiting before retry...")
-                    time.sleep(poll_interval)
-                    continue
-                
-                conn = get_database_connection(connection_string)
+    conn: Optional[pyodbc.Connection] = None
+    cursor: Optional[pyodbc.Cursor] = None
+    reconnect_delay = RECONNECT_DELAY_INITIAL
+    poll_interval = poll_config.interval
+    
+    while not shutdown_event.is_set():
+        wait: Optional[float] = None  # None means the regular, jittered poll interval.
+        try:
+            if conn is not None and conn.closed:
+                conn, cursor = None, None
+            
+            if conn is None:
+                conn = await asyncio.to_thread(get_database_connection, connection_string)
                 if not conn:
-                    time.sleep(poll_interval)
+                    logger.error(f"Database unavailable. Reconnecting in {reconnect_delay} seconds...")
+                    if await wait_for_shutdown(reconnect_delay):
+                        break
+                    reconnect_delay = min(reconnect_delay * 2, RECONNECT_DELAY_MAX)
                     continue
-                
-                with conn:
-                    cursor = conn.cursor()
-                    rows = fetch_offline_events(cursor, last_check)
-                    
-                    if rows:
-                        max_log_datetime = last_check
-                        for row in rows:
-                            message = format_slack_message(row)
-                            # Submit the task to send a Slack notification concurrently.
-                            pool.submit(
-                                send_slack_notification,
-                                slack_client,
-                                slack_channel,
-                                message
-                            )
-                            if row.log_datetime > max_log_datetime:
-                                max_log_datetime = row.log_datetime
-                        last_check = max_log_datetime
-                
+                cursor = conn.cursor()
+                cursor.arraysize = FETCH_BATCH_SIZE
+            
+            rows = await asyncio.to_thread(poll_offline_events, conn, cursor, last_check)
+            # Only a successful poll proves the connection healthy; a fresh connection is not enough.
+            reconnect_delay = RECONNECT_DELAY_INITIAL
+            
+            # One alert per swiper (game_id) per poll; rows arrive oldest first, so the latest
+            # event wins. Different games may share a description, so it is not used as the key.
+            alerts = list({row.game_id: row for row in rows}.values())
+            
+            # Collapse the poll's alerts into as few Slack messages as the block limit allows,
+            # and send those messages concurrently.
+            results = await asyncio.gather(
+                *(
+                    send_slack_notification(
+                        slack_client,
+                        slack_channel,
+                        format_slack_message(alerts[start:start + MAX_ROWS_PER_MESSAGE])
+                    )
+                    for start in range(0, len(alerts), MAX_ROWS_PER_MESSAGE)
+                ),
+                return_exceptions=True
+            )
+            failed_keys = []
+            for start, result in zip(range(0, len(alerts), MAX_ROWS_PER_MESSAGE), results):
+                if isinstance(result, Exception):
+                    logger.error(f"Unexpected error sending Slack notification: {result}")
+                if result is not True:
+                    failed_keys.extend(
+                        (row.watermark_time, row.game_id) for row in alerts[start:start + MAX_ROWS_PER_MESSAGE]
+                    )
+            
+            # Advance the watermark only past delivered alerts: stop just before the earliest
+            # undelivered one, so the next poll re-fetches it and everything after it.
+            delivered = rows
+            if failed_keys:
+                cutoff = min(failed_keys)
+                delivered = [row for row in rows if (row.watermark_time, row.game_id) < cutoff]
+                logger.warning("Some alerts were not delivered. They will be retried on the next poll.")
+            last_check = max(((row.watermark_time, row.game_id) for row in delivered), default=last_check)
+            
+            # Reached only when the poll succeeded; errors skip the adaptive adjustment.
+            if rows:
+                poll_interval = poll_config.interval_min
+            else:
+                poll_interval = min(poll_interval * 2, poll_config.interval_max)
+            
+            # Only touch the disk when a counter has changed since the last save.
+            if _metrics_dirty:
+                _metrics_dirty = False
                 save_metrics()
-                
-            except Exception as e:
-                logger.error(f"Error during monitoring loop: {e}")
-            finally:
-                try:
-                    time.sleep(poll_interval)
-                except KeyboardInterrupt:
-                    logger.info("Received KeyboardInterrupt. Initiating shutdown...")
-                    break
+            
+        except pyodbc.Error as e:
+            logger.error(f"Database error: {e}. Reconnecting in {reconnect_delay} seconds...")
+            close_database_connection(conn)
+            conn, cursor = None, None
+            wait = reconnect_delay
+            reconnect_delay = min(reconnect_delay * 2, RECONNECT_DELAY_MAX)
+        except Exception as e:
+            logger.error(f"Error during monitoring loop: {e}")
+        
+        if wait is None:
+            wait = poll_interval + random.uniform(-POLL_JITTER * poll_interval, POLL_JITTER * poll_interval)
+        if await wait_for_shutdown(wait):
+            break
+    
+    close_database_connection(conn)
+    for signum in SHUTDOWN_SIGNALS:
+        loop.remove_signal_handler(signum)
+        signal.signal(signum, signal_handler)
+
+async def run_monitor(connection_string: str, slack_config: SlackConfig, poll_config: PollConfig):
+    """
+    Creates the Slack client inside the event loop and runs the monitoring loop until shutdown.
+    
+    Slack request bodies (chat.postMessage sends its blocks as JSON) are serialized with orjson
+    through the shared aiohttp session.
+    
+    Args:
+        connection_string (str): The database connection string.
+        slack_config (SlackConfig): The Slack configuration.
+        poll_config (PollConfig): Poll interval settings, in seconds.
+    """
+    async with aiohttp.ClientSession(json_serialize=orjson_dumps) as session:
+        slack_client = ThrottledSlack(create_slack_client(slack_config.bot_token, session=session))
+        await monitor_swiper_offline_events(
+            connection_string=connection_string,
+            slack_client=slack_client,
+            slack_channel=slack_config.channel,
+            poll_config=poll_config
+        )
 
 # --- Main Entry Point ---
 
@@ -461,8 +884,8 @@ def main():
     and initiates the monitoring loop.
     """
     # Register signal handlers for graceful shutdown.
-    signal.signal(signal.SIGTERM, signal_handler)
-    signal.signal(signal.SIGINT, signal_handler)
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, signal_handler)
     
     try:
         # Ensure the logs directory exists.
@@ -474,20 +897,14 @@ def main():
         logger = setup_logging(log_file=str(log_dir / "swiper_monitor.log"))
         
         # Read configuration and build connection string.
-        db_config, slack_config, poll_interval = read_config()
+        db_config, slack_config, poll_config = read_config()
         connection_string = build_connection_string(db_config)
-        slack_client = WebClient(token=slack_config.bot_token)
         
         if not health_check(connection_string):
             logger.error("Initial health check failed. Please check configuration and connectivity.")
             return
         
-        monitor_swiper_offline_events(
-            connection_string=connection_string,
-            slack_client=slack_client,
-            slack_channel=slack_config.channel,
-            poll_interval=poll_interval
-        )
+        asyncio.run(run_monitor(connection_string, slack_config, poll_config))
         
     except Exception as e:
         logger.error(f"Fatal error: {e}")